@@ -5,11 +5,14 @@
 
 """Data loader for BertMultiLabel"""
 
+import hashlib
 import json
 import os
 
+import numpy as np
 import torch
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, Sampler, default_collate
+from transformers import AutoTokenizer
 
 __author__ = "Upal Bhattacharya"
 __license__ = ""
@@ -18,9 +21,61 @@ __version__ = "1.0"
 __email__ = "upal.bhattacharya@gmail.com"
 
 
+def worker_init_fn(worker_id):
+    """Disable tokenizer parallelism in DataLoader workers.
+
+    Tokenization is done in the main process before the workers are
+    forked, so the workers never need the tokenizer thread pool.
+    """
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+
+def collate_fn(batch):
+    """Collate a batch, trimming padding to its longest document.
+
+    Documents are cached padded to max_length, so dropping the padding
+    columns beyond the longest document in the batch gives dynamic padding.
+    """
+    data, target = default_collate(batch)
+    length = int(data["attention_mask"].sum(dim=-1).max())
+    data = {k: v[:, :length].contiguous() for k, v in data.items()}
+
+    return data, target
+
+
+class LengthGroupedSampler(Sampler):
+    """Sample indices so that batches hold documents of similar length.
+
+    Indices are shuffled, split into mega-batches of mega_batch_mult
+    batches and sorted by length within each mega-batch (as done by the
+    HuggingFace Trainer), which keeps some randomness while cutting down
+    on padding.
+    """
+
+    def __init__(self, lengths, batch_size, mega_batch_mult=50):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.mega_batch_mult = mega_batch_mult
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __iter__(self):
+        indices = torch.randperm(len(self.lengths)).tolist()
+        mega_batch_size = self.batch_size * self.mega_batch_mult
+        mega_batches = [
+            sorted(indices[i:i + mega_batch_size],
+                   key=lambda idx: self.lengths[idx], reverse=True)
+            for i in range(0, len(indices), mega_batch_size)]
+
+        return iter([idx for mega_batch in mega_batches
+                     for idx in mega_batch])
+
+
 class BertMultiLabelDataset(Dataset):
     def __init__(self, data_paths, targets_paths, unique_labels=None,
-                 mode="train"):
+                 mode="train", bert_model_name="bert-large-uncased",
+                 max_length=512, truncation_side="left", cache_dir=None):
         self.data_paths = data_paths
         self.targets_paths = targets_paths
         if unique_labels is None:
@@ -37,16 +92,32 @@ class BertMultiLabelDataset(Dataset):
 
         self.targets_dict = self.get_targets()
         self.mode = mode
+        # Targets of all documents are built once as a uint8 matrix.
+        # The float cast is left to the loss.
+        if self.mode == "train":
+            self.targets = torch.stack([self.fetch_target(self.idx[i])
+                                        for i in range(len(self))])
+
+        self.bert_model_name = bert_model_name
+        self.max_length = max_length
+        self.truncation_side = truncation_side
+        # Tokenizing once up front so that epochs do not re-tokenize
+        self.input_ids, self.attention_mask = self.tokenize(cache_dir)
+        # Number of tokens in each document, used for length grouping
+        self.lengths = self.attention_mask.sum(axis=-1).tolist()
 
     def __len__(self):
         return len(self.text_paths.keys())
 
     def __getitem__(self, idx):
-        data = self.load_data(self.text_paths[self.idx[idx]])
-        target = self.fetch_target(self.idx[idx])
-
+        data = {
+            "input_ids": torch.from_numpy(
+                self.input_ids[idx].astype(np.int64)),
+            "attention_mask": torch.from_numpy(
+                self.attention_mask[idx].astype(np.int64)),
+            }
         if self.mode == "train":
-            return data, target
+            return data, self.targets[idx]
         else:
             flname = os.path.splitext(os.path.basename(self.idx[idx]))[0]
             return flname, data
@@ -91,7 +162,8 @@ class BertMultiLabelDataset(Dataset):
             Tensor containing the target tensors.
         """
         target = torch.tensor([int(label in self.targets_dict[doc])
-                               for label in self.unique_labels])
+                               for label in self.unique_labels],
+                              dtype=torch.uint8)
 
         return target
 
@@ -100,6 +172,90 @@ class BertMultiLabelDataset(Dataset):
             data = f.read()
         return data
 
+    def tokenize(self, cache_dir=None, chunk_size=1024):
+        """Tokenize all documents, caching the result on disk.
+
+        Parameters
+        ----------
+        cache_dir : str
+            Directory to save the tokenized documents to as memory-mapped
+            arrays. If None, the documents are tokenized in memory.
+        chunk_size : int
+            Number of documents to tokenize at a time.
+
+        Returns
+        -------
+        input_ids : numpy.ndarray
+            Token IDs of the documents padded to max_length.
+        attention_mask : numpy.ndarray
+            Attention masks of the documents.
+        """
+        shape = (len(self), self.max_length)
+
+        if cache_dir is None:
+            input_ids = np.empty(shape, dtype=np.int32)
+            attention_mask = np.empty(shape, dtype=np.uint8)
+        else:
+            # Cache depends on the documents (including their modification
+            # times and sizes, so edited documents are re-tokenized) and the
+            # tokenization settings
+            paths = [self.text_paths[self.idx[i]] for i in range(len(self))]
+            key = hashlib.md5(json.dumps(
+                [[(path, os.path.getmtime(path), os.path.getsize(path))
+                  for path in paths],
+                 self.bert_model_name, self.max_length,
+                 self.truncation_side]).encode()).hexdigest()
+            ids_path = os.path.join(cache_dir, f"{key}_input_ids.npy")
+            mask_path = os.path.join(cache_dir, f"{key}_attention_mask.npy")
+
+            if os.path.exists(ids_path) and os.path.exists(mask_path):
+                return (np.load(ids_path, mmap_mode='r'),
+                        np.load(mask_path, mmap_mode='r'))
+
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir)
+
+            # Writing to temporary files so an interrupted run does not
+            # leave a partial cache behind
+            input_ids = np.lib.format.open_memmap(
+                    f"{ids_path}.tmp", mode="w+", dtype=np.int32,
+                    shape=shape)
+            attention_mask = np.lib.format.open_memmap(
+                    f"{mask_path}.tmp", mode="w+", dtype=np.uint8,
+                    shape=shape)
+
+        # The fast (Rust) tokenizer encodes each chunk in parallel.
+        # Setting this explicitly also silences the warning when DataLoader
+        # workers are forked afterwards (see worker_init_fn).
+        os.environ.setdefault("TOKENIZERS_PARALLELISM", "true")
+        tokenizer = AutoTokenizer.from_pretrained(
+                                self.bert_model_name, use_fast=True,
+                                truncation_side=self.truncation_side)
+
+        for start in range(0, len(self), chunk_size):
+            end = min(start + chunk_size, len(self))
+            texts = [self.load_data(self.text_paths[self.idx[i]])
+                     for i in range(start, end)]
+            tokenized = tokenizer(texts, truncation=True,
+                                  padding="max_length",
+                                  max_length=self.max_length,
+                                  return_tensors="np")
+            input_ids[start:end] = tokenized["input_ids"]
+            attention_mask[start:end] = tokenized["attention_mask"]
+
+        if cache_dir is None:
+            return input_ids, attention_mask
+
+        input_ids.flush()
+        attention_mask.flush()
+        del input_ids
+        del attention_mask
+        os.replace(f"{ids_path}.tmp", ids_path)
+        os.replace(f"{mask_path}.tmp", mask_path)
+
+        return (np.load(ids_path, mmap_mode='r'),
+                np.load(mask_path, mmap_mode='r'))
+
     def get_unique_labels(self):
 
         # Keeping it as a list for ordering ??
@@ -5,7 +5,7 @@
 
 """Evaluation script for BertMultiLabel"""
 
-import numpy as np
+import torch
 
 import utils
 
@@ -16,36 +16,34 @@ def evaluate(model, loss_fn, data_loader, params, metrics, args, target_names):
     model.eval()
 
     # Accumulate data of batches
-    accumulate = utils.Accumulate()
+    accumulate = utils.Accumulate(len(data_loader.dataset),
+                                  len(target_names), args.device)
     loss_batch = []
 
+    # Model returns logits so the threshold is moved to logit space
+    threshold = utils.logit(params.threshold)
+
     criterion = loss_fn
 
     for data, target in iter(data_loader):
-        target = target.to(args.device)
-
-        y_pred = model(data)
-
-        loss = criterion(y_pred.float(), target.float())
+        target = target.to(args.device, non_blocking=True)
 
-        outputs_batch = (y_pred.data.cpu().numpy()
-                         > params.threshold).astype(np.int32)
-        targets_batch = (target.data.cpu.numpy()).astype(np.int32)
+        # No gradients are needed for evaluation
+        with torch.no_grad(), torch.autocast(device_type="cuda",
+                                             dtype=torch.bfloat16,
+                                             enabled="cuda" in args.device):
+            y_pred = model(data)
 
-        accumulate.update(outputs_batch, targets_batch)
-        loss_batch.append(loss.item())
+            loss = criterion(y_pred.float(), target.float())
 
-        del data
-        del target
-        del y_pred
-        del outputs_batch
-        del targets_batch
+        accumulate.update_logits(y_pred.detach(), target, threshold)
+        loss_batch.append(loss.detach())
 
     output, targets = accumulate()
 
     summary_batch = {metric: metrics[metric](output, targets, target_names)
                      for metric in metrics}
 
-    summary_batch["loss_avg"] = sum(loss_batch) * 1./len(loss_batch)
+    summary_batch["loss_avg"] = torch.stack(loss_batch).mean().item()
 
     return summary_batch
@@ -41,7 +41,10 @@ def generate_embeddings(model, data_loader, params, args):
         doc, data = data_loader[idx]
         logging.info(f"Generating embeddings for {doc}.")
 
-        y_pred, embed = model(data)
+        # Dropping the padding and adding the batch dimension
+        length = int(data["attention_mask"].sum())
+        y_pred, embed = model({k: v[:length].unsqueeze(0)
+                               for k, v in data.items()})
 
         # Removing from computation graph
         embed = embed.cpu().detach()
@@ -117,14 +120,16 @@ def main():
                             data_paths=args.data_dirs,
                             targets_paths=args.targets_paths,
                             unique_labels=args.unique_labels,
-                            mode="generate")
+                            mode="generate",
+                            bert_model_name=args.bert_model_name,
+                            max_length=params.max_length,
+                            truncation_side=params.truncation_side,
+                            cache_dir=os.path.join(args.exp_dir, "cache"))
 
     model = BertMultiLabel(labels=dataset.unique_labels,
                            device=args.device,
                            hidden_size=params.hidden_dim,
-                           max_length=params.max_length,
                            bert_model_name=args.bert_model_name,
-                           truncation_side=params.truncation_side,
                            mode="generate")
 
     model.to(args.device)
@@ -8,7 +8,6 @@
 from typing import MutableSequence
 
 import numpy as np
-from sklearn.metrics import precision_recall_fscore_support as prfs
 
 __author__ = "Upal Bhattacharya"
 __license__ = ""
@@ -17,6 +16,44 @@ __version__ = "1.0"
 __email__ = "upal.bhattacharya@gmail.com"
 
 
+def safe_divide(num: np.ndarray, den: np.ndarray) -> np.ndarray:
+    """Divide elementwise, returning 0 where the denominator is 0."""
+    num = np.asarray(num, dtype=np.float64)
+    return np.divide(num, den, out=np.zeros_like(num), where=den != 0)
+
+
+def confusion_counts(outputs_batch: MutableSequence,
+                     targets_batch: MutableSequence) -> tuple:
+    """Calculate per class true positives, false positives and false
+    negatives in a single sweep over the predictions and targets.
+
+    Parameters
+    ----------
+    outputs_batch : MutableSequence
+        Predictions of a batch.
+    targets_batch : MutableSequence
+        Targets of the batch.
+
+    Returns
+    -------
+    tp : numpy.ndarray
+        True positives of each class.
+    fp : numpy.ndarray
+        False positives of each class.
+    fn : numpy.ndarray
+        False negatives of each class.
+
+    """
+    outputs_batch = np.asarray(outputs_batch, dtype=bool)
+    targets_batch = np.asarray(targets_batch, dtype=bool)
+
+    tp = (outputs_batch & targets_batch).sum(axis=0)
+    fp = (outputs_batch & ~targets_batch).sum(axis=0)
+    fn = (~outputs_batch & targets_batch).sum(axis=0)
+
+    return tp, fp, fn
+
+
 def custom_f1(outputs_batch: MutableSequence,
               targets_batch: MutableSequence, target_names: list[str]) -> dict:
     """Calculate per class and macro F1 between the given predictions
@@ -38,38 +75,22 @@ def custom_f1(outputs_batch: MutableSequence,
 
     """
 
-    per_class_prec = []
-    per_class_rec = []
-
-    num_classes = targets_batch.shape[-1]
-
-    for cls in range(num_classes):
-        tp = np.dot(targets_batch[:, cls], outputs_batch[:, cls])
-        pp = np.sum(outputs_batch[:, cls])
-        p = np.sum(targets_batch[:, cls])
-        prec = tp/pp if pp != 0 else 0
-        rec = tp/p if p != 0 else 0
-
-        per_class_prec.append(prec)
-        per_class_rec.append(rec)
+    tp, fp, fn = confusion_counts(outputs_batch, targets_batch)
 
-    den = [per_class_prec[i] + per_class_rec[i]
-           for i in range(len(per_class_rec))]
-    num = [2 * (per_class_prec[i] * per_class_rec[i])
-           for i in range(len(per_class_rec))]
+    per_class_prec = safe_divide(tp, tp + fp)
+    per_class_rec = safe_divide(tp, tp + fn)
+    per_class_f1 = safe_divide(2 * per_class_prec * per_class_rec,
+                               per_class_prec + per_class_rec)
 
-    per_class_f1 = [num_val * 1./den_val if den_val != 0 else 0
-                    for num_val, den_val in zip(num, den)]
-
-    macro_f1 = sum(per_class_f1) * 1./len(per_class_f1)
+    macro_f1 = float(per_class_f1.mean())
 
     # Converting metrics to dictionaries for easier understanding
     per_class_prec = {
-            k: per_class_prec[i] for i, k in enumerate(target_names)}
+            k: float(per_class_prec[i]) for i, k in enumerate(target_names)}
     per_class_rec = {
-            k: per_class_rec[i] for i, k in enumerate(target_names)}
+            k: float(per_class_rec[i]) for i, k in enumerate(target_names)}
     per_class_f1 = {
-            k: per_class_f1[i] for i, k in enumerate(target_names)}
+            k: float(per_class_f1[i]) for i, k in enumerate(target_names)}
 
     scores = {
         'precision': per_class_prec,
@@ -101,14 +122,25 @@ def f1(outputs_batch: MutableSequence,
         Dictionary containing the metric values.
 
     """
-    class_metrics = prfs(targets_batch, outputs_batch, average=None)
-    per_class_prec, per_class_rec, per_class_f1, per_class_sup = class_metrics
-
-    macro_metrics = prfs(targets_batch, outputs_batch, average='macro')
-    macro_prec, macro_rec, macro_f1, macro_sup = macro_metrics
-
-    micro_metrics = prfs(targets_batch, outputs_batch, average='micro')
-    micro_prec, micro_rec, micro_f1, micro_sup = micro_metrics
+    # Per class, macro and micro scores all reuse the same counts.
+    # Scores with a zero denominator are set to 0.
+    tp, fp, fn = confusion_counts(outputs_batch, targets_batch)
+
+    per_class_prec = safe_divide(tp, tp + fp)
+    per_class_rec = safe_divide(tp, tp + fn)
+    per_class_f1 = safe_divide(2 * tp, 2 * tp + fp + fn)
+    per_class_sup = tp + fn
+
+    macro_prec = per_class_prec.mean()
+    macro_rec = per_class_rec.mean()
+    macro_f1 = per_class_f1.mean()
+    macro_sup = None
+
+    tp, fp, fn = tp.sum(), fp.sum(), fn.sum()
+    micro_prec = safe_divide(tp, tp + fp)
+    micro_rec = safe_divide(tp, tp + fn)
+    micro_f1 = safe_divide(2 * tp, 2 * tp + fp + fn)
+    micro_sup = None
 
     # Converting metrics to dictionaries for easier understanding
     per_class_prec = {
@@ -10,7 +10,7 @@ import re
 import torch
 import torch.nn as nn
 
-from transformers import BertModel, BertTokenizer
+from transformers import BertModel
 
 __author__ = "Upal Bhattacharya"
 __license__ = ""
@@ -23,24 +23,16 @@ class BertMultiLabel(nn.Module):
 
     """BERT-based model for multi-label classification"""
 
-    def __init__(self, labels, device, hidden_size=1024, max_length=512,
-                 bert_model_name="bert-large-uncased",
-                 truncation_side="left", mode="train"):
+    def __init__(self, labels, device, hidden_size=1024,
+                 bert_model_name="bert-large-uncased", mode="train"):
         super(BertMultiLabel, self).__init__()
         self.hidden_size = hidden_size
         self.device = device
-        self.max_length = max_length
         self.labels = [re.sub(r'[^A-Za-z]', '', label)
                        for label in labels]
         self.bert_model_name = bert_model_name
         self.bert_model = BertModel.from_pretrained(self.bert_model_name)
-        self.truncation_side = truncation_side
         self.mode = mode
-        # Keeping the tokenizer here makes the model better behaved
-        # as opposed to using it in the DataLoader
-        self.bert_tokenizer = BertTokenizer.from_pretrained(
-                                        self.bert_model_name,
-                                        truncation_side=self.truncation_side)
 
         self.prediction = nn.ModuleDict({
             k: nn.Linear(in_features=self.hidden_size,
@@ -48,27 +40,21 @@ class BertMultiLabel(nn.Module):
                          bias=True,)
             for k in self.labels})
 
-    def process(self, x):
-        tokenized = self.bert_tokenizer(x, truncation=True, padding="longest",
-                                        max_length=self.max_length,
-                                        return_tensors="pt")
-        return tokenized
-
     def forward(self, x):
-        tokenized = self.process(x)
-        tokenized = tokenized.to(self.device)
+        # Inputs are tokenized beforehand by the dataset
+        tokenized = {k: v.to(self.device, non_blocking=True)
+                     for k, v in x.items()}
         preds = torch.tensor([])
         preds = preds.to(self.device)
 
         encoding = self.bert_model(**tokenized)
         # Retaining only the [CLS] token
         cls = encoding.last_hidden_state[:, 0, :]
-        m = nn.Sigmoid()
         for label in self.labels:
             pred = self.prediction[label](cls)
             preds = torch.cat((preds, pred), dim=-1)
 
-        preds = m(preds)
+        # Returning logits, the sigmoid is fused into the loss
         if self.mode == "train":
             return preds
         else:
@@ -8,15 +8,16 @@
 import argparse
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 
-import numpy as np
 import torch
 import torch.nn as nn
 import torch.optim as optim
 from torch.utils.data import DataLoader
 
 import utils
-from data_generator import BertMultiLabelDataset
+from data_generator import (BertMultiLabelDataset, LengthGroupedSampler,
+                            collate_fn, worker_init_fn)
 from evaluate import evaluate
 from metrics import metrics
 from model.net import BertMultiLabel
@@ -29,7 +30,7 @@ __email__ = "upal.bhattacharya@gmail.com"
 
 
 def train_one_epoch(model, optimizer, loss_fn, data_loader, params,
-                    metrics, target_names, args):
+                    metrics, target_names, args, scaler):
 
     # Set model to train
     model.train()
@@ -38,59 +39,71 @@ def train_one_epoch(model, optimizer, loss_fn, data_loader, params,
 
     # For the loss of each batch
     loss_batch = []
-    accumulate = utils.Accumulate()
+    accumulate = utils.Accumulate(len(data_loader.dataset),
+                                  len(target_names), args.device)
+    # Model returns logits so the threshold is moved to logit space
+    threshold = utils.logit(params.threshold)
+    log_every = getattr(params, "log_every", 50)
 
     # Training Loop
     for i, (data, target) in enumerate(iter(data_loader)):
-        logging.info(f"Training on batch {i + 1}.")
-        target = target.to(args.device)
-        # Data is moved to relevant device in net.py after tokenization
-        y_pred = model(data)
-        loss = criterion(y_pred.float(), target.float())
-        loss.backward()
+        if (i + 1) % log_every == 0:
+            logging.info(f"Training on batch {i + 1}.")
+        target = target.to(args.device, non_blocking=True)
+        # Data is moved to relevant device in net.py
+        with torch.autocast(device_type="cuda", dtype=torch.bfloat16,
+                            enabled=scaler.is_enabled()):
+            y_pred = model(data)
+            loss = criterion(y_pred.float(), target.float())
+        # Scaling so that the accumulated gradients are an average over
+        # the sub-batches
+        scaler.scale(loss / params.update_grad_every).backward()
+        # Kept on device to avoid a sync every batch
+        loss_batch.append(loss.detach())
 
         # Sub-batching behaviour to prevent memory overload
         if (i + 1) % params.update_grad_every == 0:
-            optimizer.step()
-            optimizer.zero_grad()
-            loss_batch.append(loss.item())
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad(set_to_none=True)
 
-        outputs_batch = (y_pred.data.cpu().detach().numpy()
-                         > params.threshold).astype(np.int32)
-
-        targets_batch = (target.data.cpu().detach().numpy()).astype(np.int32)
-
-        accumulate.update(outputs_batch, targets_batch)
-
-        # For debugging purposes
-        print(y_pred)
-
-        del data
-        del target
-        del outputs_batch
-        del targets_batch
-        del y_pred
-        torch.cuda.empty_cache()
+        # Thresholding is kept on device and the predictions are moved to
+        # the CPU once at the end of the epoch.
+        accumulate.update_logits(y_pred.detach(), target, threshold)
 
     else:
         # Last batch
-        if (i + 1) % params.update_grad_every != 0:
-            optimizer.step()
-            optimizer.zero_grad()
-            loss_batch.append(loss.item())
+        remainder = (i + 1) % params.update_grad_every
+        if remainder != 0:
+            # Rescaling so that the gradients are an average over the
+            # sub-batches actually accumulated
+            scaler.unscale_(optimizer)
+            for group in optimizer.param_groups:
+                for param in group["params"]:
+                    if param.grad is not None:
+                        param.grad.mul_(params.update_grad_every / remainder)
+            scaler.step(optimizer)
+            scaler.update()
+            optimizer.zero_grad(set_to_none=True)
 
     outputs, targets = accumulate()
 
+    # Releasing cached blocks once per epoch instead of every batch
+    if "cuda" in args.device:
+        with torch.cuda.device(args.device):
+            torch.cuda.empty_cache()
+
     summary_batch = {metric: metrics[metric](outputs, targets, target_names)
                      for metric in metrics}
-    summary_batch["loss_avg"] = sum(loss_batch) * 1./len(loss_batch)
+    summary_batch["loss_avg"] = torch.stack(loss_batch).mean().item()
 
     return summary_batch
 
 
 def train_and_evaluate(model, optimizer, loss_fn, train_loader,
                        test_loader, params, metrics, exp_dir, name, args,
-                       target_names, restore_file=None):
+                       target_names, restore_file=None,
+                       train_eval_loader=None):
     # Default start epoch
     start_epoch = 0
     # Best train and test macro f1 variables
@@ -105,17 +118,34 @@ def train_and_evaluate(model, optimizer, loss_fn, train_loader,
 
         start_epoch = utils.load_checkpoint(restore_path, model, optimizer) + 1
 
+    # Mixed precision is only used when training on GPU
+    scaler = torch.amp.GradScaler("cuda", enabled="cuda" in args.device)
+
+    # Output directories
+    train_metrics_dir = os.path.join(exp_dir, "metrics", f"{name}", "train")
+    test_metrics_dir = os.path.join(exp_dir, "metrics", f"{name}", "test")
+    model_states_dir = os.path.join(exp_dir, "model_states", f"{name}")
+
+    # Checkpoints are written by a background thread while training goes on
+    executor = ThreadPoolExecutor(max_workers=1)
+    save_future = None
+
     for epoch in range(start_epoch, params.num_epochs):
         logging.info(f"Logging for epoch {epoch}.")
 
-        _ = train_one_epoch(model, optimizer, loss_fn, train_loader,
-                            params, metrics, target_names, args)
+        train_stats = train_one_epoch(model, optimizer, loss_fn,
+                                      train_loader, params, metrics,
+                                      target_names, args, scaler)
 
         test_stats = evaluate(model, loss_fn, test_loader,
                               params, metrics, args, target_names)
 
-        train_stats = evaluate(model, loss_fn, train_loader,
-                               params, metrics, args, target_names)
+        # Stats collected during training are used unless a separate pass
+        # over the training set is asked for
+        if (args.eval_train_every > 0
+                and (epoch + 1) % args.eval_train_every == 0):
+            train_stats = evaluate(model, loss_fn, train_eval_loader,
+                                   params, metrics, args, target_names)
 
         # Getting f1 test_stats
 
@@ -133,13 +163,11 @@ def train_and_evaluate(model, optimizer, loss_fn, train_loader,
 
         # Save test_stats
         train_json_path = os.path.join(
-                exp_dir, "metrics", f"{name}", "train",
-                f"epoch_{epoch + 1}_train_f1.json")
+                train_metrics_dir, f"epoch_{epoch + 1}_train_f1.json")
         utils.save_dict_to_json(train_stats, train_json_path)
 
         test_json_path = os.path.join(
-                exp_dir, "metrics", f"{name}", "test",
-                f"epoch_{epoch + 1}_test_f1.json")
+                test_metrics_dir, f"epoch_{epoch + 1}_test_f1.json")
         utils.save_dict_to_json(test_stats, test_json_path)
 
         # Saving best stats
@@ -147,18 +175,16 @@ def train_and_evaluate(model, optimizer, loss_fn, train_loader,
             best_train_macro_f1 = train_macro_f1
             train_stats["epoch"] = epoch + 1
 
-            best_json_path = os.path.join(
-                    exp_dir, "metrics", f"{name}", "train",
-                    "best_train_f1.json")
+            best_json_path = os.path.join(train_metrics_dir,
+                                          "best_train_f1.json")
             utils.save_dict_to_json(train_stats, best_json_path)
 
         if is_test_best:
             best_test_macro_f1 = test_macro_f1
             test_stats["epoch"] = epoch + 1
 
-            best_json_path = os.path.join(
-                    exp_dir, "metrics", f"{name}", "test",
-                    "best_test_f1.json")
+            best_json_path = os.path.join(test_metrics_dir,
+                                          "best_test_f1.json")
             utils.save_dict_to_json(test_stats, best_json_path)
 
             logging.info(
@@ -167,21 +193,34 @@ def train_and_evaluate(model, optimizer, loss_fn, train_loader,
                      f"Avg test loss: {test_stats['loss_avg']} "
                      f"Avg train loss: {train_stats['loss_avg']}."))
 
-        state = {
-            "epoch": epoch + 1,
-            "state_dict": model.state_dict(),
-            "optim_dict": optimizer.state_dict(),
-            }
+        # The last epoch is always saved
+        to_save = ((epoch + 1) % params.save_every == 0
+                   or epoch + 1 == params.num_epochs)
 
-        utils.save_checkpoint(state, is_test_best,
-                              os.path.join(exp_dir, "model_states", f"{name}"),
-                              (epoch + 1) % params.save_every == 0)
+        # Only building the state when there is something to save
+        if to_save or is_test_best:
+            # Waiting on the previous save and releasing its copy before
+            # building the new one, so only one copy is held at a time
+            if save_future is not None:
+                save_future.result()
+                state = None
 
-    # For the last epoch
+            # Copying to the CPU so the saved state is not changed by
+            # training
+            state = utils.state_to_cpu({
+                "epoch": epoch + 1,
+                "state_dict": model.state_dict(),
+                "optim_dict": optimizer.state_dict(),
+                })
 
-    utils.save_checkpoint(state, is_test_best,
-                          os.path.join(exp_dir, "model_states", f"{name}"),
-                          True)
+            save_future = executor.submit(utils.save_checkpoint, state,
+                                          is_test_best, model_states_dir,
+                                          to_save)
+
+    # Making sure all checkpoints are written
+    if save_future is not None:
+        save_future.result()
+    executor.shutdown()
 
 
 def main():
@@ -211,6 +250,12 @@ def main():
     parser.add_argument("-bm", "--bert_model_name", type=str,
                         default="bert-large-uncased",
                         help="BERT variant to use as model.")
+    parser.add_argument("-c", "--compile", action="store_true",
+                        help="Compile the model with torch.compile.")
+    parser.add_argument("-et", "--eval_train_every", type=int, default=0,
+                        help=("Evaluate on the training set every given "
+                              "number of epochs. Stats from training are "
+                              "used otherwise."))
 
     args = parser.parse_args()
 
@@ -237,6 +282,12 @@ def main():
     if "cuda" in args.device:
         torch.cuda.manual_seed(47)
 
+    # Allowing TF32 matmuls and letting cuDNN pick the fastest kernels
+    torch.set_float32_matmul_precision('high')
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
+
     # Setting data paths
     train_paths = []
     test_paths = []
@@ -245,40 +296,89 @@ def main():
         test_paths.append(os.path.join(path, "test"))
 
     # Datasets
+    cache_dir = os.path.join(args.exp_dir, "cache")
     train_dataset = BertMultiLabelDataset(
                                     data_paths=train_paths,
                                     targets_paths=args.targets_paths,
-                                    unique_labels=args.unique_labels)
+                                    unique_labels=args.unique_labels,
+                                    bert_model_name=args.bert_model_name,
+                                    max_length=params.max_length,
+                                    truncation_side=params.truncation_side,
+                                    cache_dir=cache_dir)
 
     test_dataset = BertMultiLabelDataset(
                                     data_paths=test_paths,
                                     targets_paths=args.targets_paths,
-                                    unique_labels=args.unique_labels)
+                                    unique_labels=args.unique_labels,
+                                    bert_model_name=args.bert_model_name,
+                                    max_length=params.max_length,
+                                    truncation_side=params.truncation_side,
+                                    cache_dir=cache_dir)
 
     # Dataloaders
+    # Workers prefetch batches in the background so the GPU is not left
+    # waiting on data loading between steps
+    num_workers = min(8, os.cpu_count() or 1)
+    pin_memory = "cuda" in args.device
+
+    # Batches are padded to their longest document and training batches
+    # are grouped by length to cut down on padding
+    train_sampler = LengthGroupedSampler(train_dataset.lengths,
+                                         params.batch_size)
+
     train_loader = DataLoader(train_dataset, batch_size=params.batch_size,
-                              shuffle=True)
+                              sampler=train_sampler, num_workers=num_workers,
+                              pin_memory=pin_memory, persistent_workers=True,
+                              prefetch_factor=2, collate_fn=collate_fn,
+                              worker_init_fn=worker_init_fn)
 
     test_loader = DataLoader(test_dataset, batch_size=params.batch_size,
-                             shuffle=True)
+                             shuffle=False, num_workers=num_workers,
+                             pin_memory=pin_memory, persistent_workers=True,
+                             prefetch_factor=2, collate_fn=collate_fn,
+                             worker_init_fn=worker_init_fn)
+
+    # Separate unshuffled loader, only needed when evaluating on the
+    # training set
+    train_eval_loader = None
+    if args.eval_train_every > 0:
+        train_eval_loader = DataLoader(train_dataset,
+                                       batch_size=params.batch_size,
+                                       shuffle=False, num_workers=num_workers,
+                                       pin_memory=pin_memory,
+                                       collate_fn=collate_fn,
+                                       worker_init_fn=worker_init_fn)
 
     model = BertMultiLabel(labels=train_dataset.unique_labels,
                            device=args.device,
                            hidden_size=params.hidden_dim,
-                           max_length=params.max_length,
-                           bert_model_name=args.bert_model_name,
-                           truncation_side=params.truncation_side)
+                           bert_model_name=args.bert_model_name)
 
     model.to(args.device)
 
+    # Compiling in-place keeps the state dict keys unchanged for checkpoints.
+    # Token lengths vary between batches so shapes are marked dynamic.
+    if args.compile:
+        model.compile(dynamic=True)
+
     # Defining optimizer and loss function
-    optimizer = optim.Adam(model.parameters(), lr=params.lr)
-    loss_fn = nn.BCELoss(reduction='sum')
+    # Fused kernels need CUDA and a recent torch, falling back to the
+    # multi-tensor implementation otherwise
+    weight_decay = getattr(params, "weight_decay", 0.0)
+    try:
+        optimizer = optim.AdamW(model.parameters(), lr=params.lr,
+                                weight_decay=weight_decay,
+                                fused="cuda" in args.device)
+    except (TypeError, RuntimeError):
+        optimizer = optim.AdamW(model.parameters(), lr=params.lr,
+                                weight_decay=weight_decay, foreach=True)
+    loss_fn = nn.BCEWithLogitsLoss(reduction='sum')
 
     train_and_evaluate(model, optimizer, loss_fn, train_loader,
                        test_loader, params, metrics, args.exp_dir,
                        args.name, args, train_dataset.unique_labels,
-                       restore_file=args.restore_file)
+                       restore_file=args.restore_file,
+                       train_eval_loader=train_eval_loader)
 
     logging.info("="*80)
 
@@ -7,11 +7,12 @@
 
 import json
 import logging
+import logging.handlers
+import math
 import os
 
 import torch
 import torch.nn as nn
-import numpy as np
 
 __author__ = "Upal Bhattacharya"
 __copyright__ = ""
@@ -39,20 +40,41 @@ class Params:
 
 
 class Accumulate:
-    """Maintain all data used in an epoch for metrics calculation."""
+    """Maintain all data used in an epoch for metrics calculation.
+
+    Outputs and targets are written into buffers preallocated for the
+    given number of samples and labels, on the device they are produced
+    on, and moved to the CPU once at the end of the epoch.
+    """
+
+    def __init__(self, num_samples, num_labels, device=None):
+        self.count = 0
+        self.output_batch = torch.empty((num_samples, num_labels),
+                                        dtype=torch.bool, device=device)
+        self.targets_batch = torch.empty((num_samples, num_labels),
+                                         dtype=torch.bool, device=device)
+
+    def update_logits(self, logits, targets_batch, threshold):
+        """Threshold logits directly into the output buffer."""
+        end = self.count + logits.shape[0]
+        torch.gt(logits, threshold, out=self.output_batch[self.count:end])
+        self.targets_batch[self.count:end] = targets_batch
+        self.count = end
 
-    def __init__(self):
-        self.output_batch = []
-        self.targets_batch = []
+    def __call__(self):
 
-    def update(self, output_batch, targets_batch):
-        self.output_batch.extend(output_batch.tolist())
-        self.targets_batch.extend(targets_batch.tolist())
+        return (self.output_batch[:self.count].cpu().numpy(),
+                self.targets_batch[:self.count].cpu().numpy())
 
-    def __call__(self):
 
-        return (np.stack(self.output_batch, axis=0),
-                np.stack(self.targets_batch, axis=0))
+def logit(p):
+    """Inverse of the sigmoid, for comparing thresholds against logits."""
+    # Thresholds of 0 and 1 map to the infinite ends of the logit range
+    if p <= 0:
+        return -math.inf
+    if p >= 1:
+        return math.inf
+    return math.log(p / (1 - p))
 
 
 def load_checkpoint(restore_path, model, optimizer=None, device_id=None):
@@ -81,6 +103,26 @@ def save_dict_to_json(dict_obj, save_path):
         json.dump(dict_obj, f, indent=4)
 
 
+def state_to_cpu(state):
+    """Recursively copy the tensors of a (nested) state dict to the CPU.
+
+    Tensors are always copied, so the result is unaffected by further
+    training and can be saved from another thread.
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        cpu_state = type(state)(
+            (k, state_to_cpu(v)) for k, v in state.items())
+        # Module state dicts carry version metadata used when loading
+        if hasattr(state, "_metadata"):
+            cpu_state._metadata = state._metadata
+        return cpu_state
+    if isinstance(state, (list, tuple)):
+        return type(state)(state_to_cpu(v) for v in state)
+    return state
+
+
 def save_checkpoint(state, is_best, save_path, to_save=False):
     if not(os.path.exists(save_path)):
         os.makedirs(save_path)
@@ -104,7 +146,10 @@ def set_logger(log_path: str):
         file_handler.setFormatter(logging.Formatter(
             "%(asctime)s: [%(levelname)s] %(message)s",
             "%Y-%m-%d %H:%M:%S"))
-        logger.addHandler(file_handler)
+        # Buffering records so that logging does not write to disk on
+        # every call. Errors and exit flush the buffer.
+        logger.addHandler(logging.handlers.MemoryHandler(
+            capacity=1024, target=file_handler))
 
         # Stream handler
         stream_handler = logging.StreamHandler()